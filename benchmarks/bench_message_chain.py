@@ -0,0 +1,146 @@
+"""
+micro benchmark for building openai payloads from a 100 turn adventure chain
+
+full: every stored turn is sent, the request and api log payloads for the validate and next action calls
+live: the handle_adventure_message path, 10 consecutive turns on a 100 turn chain each truncated to 21 turns
+      before the validate and next action prompts, the cached path reuses a ChainCache across the turns
+
+python benchmarks/bench_message_chain.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.message_chain import ChainCache, MessageChain, SYSTEM, USER, ASSISTANT  # noqa: E402
+
+TURN_COUNT = 100
+TURNS_PLAYED = 10
+MAX_HISTORY_TURNS = 21  # same history window as bot.handle_adventure_message
+CHAIN_ID = 1
+MODEL = "gpt-3.5-turbo"
+TEMPERATURE = 0.7
+SYSTEM_CONTENT = "You are the narrator of a fictional Choose Your Own Adventure game. " * 8
+USER_CONTENT = "I open the \"old\" door and walk into the hall. " * 3
+ASSISTANT_CONTENT = "The hall is dark, a cold wind blows through the broken windows. " * 12
+VALIDATE_PROMPT = "Is this a valid action? {message}"
+NEXT_ACTION_PROMPT = "What happens next? {message}"
+
+rows = [(USER_CONTENT, ASSISTANT_CONTENT) for _ in range(TURN_COUNT)]
+
+
+def legacy_chain(chain_rows: list) -> list:
+    # mirrors the previous list of dicts get_message_chain
+    message_chain = [{"role": "system", "content": f"{SYSTEM_CONTENT}"}]
+    for user, assistant in chain_rows:
+        message_chain.extend([{
+            "role": "user",
+            "content": f"{user}"
+        }, {
+            "role": "assistant",
+            "content": f"{assistant}"
+        }])
+
+    return message_chain
+
+
+def legacy_payloads(message_chain: list) -> list:
+    # mirrors the previous generate_* functions, json.dumps once for the request and once for the api log
+    payloads = []
+    for prompt in (VALIDATE_PROMPT, NEXT_ACTION_PROMPT):
+        message_chain.append({"role": "user", "content": prompt.format(message=USER_CONTENT)})
+        json_data = {"model": MODEL, "messages": message_chain, "temperature": TEMPERATURE}
+        json.dumps(json_data)  # request body
+        payloads.append(json.dumps(json_data))  # api log
+
+    return payloads
+
+
+def build_chain(chain_rows: list) -> MessageChain:
+    message_chain = MessageChain()
+    message_chain.add(SYSTEM, SYSTEM_CONTENT)
+    for user, assistant in chain_rows:
+        message_chain.add(USER, user)
+        message_chain.add(ASSISTANT, assistant)
+
+    return message_chain
+
+
+def message_chain_payloads(message_chain: MessageChain) -> list:
+    payloads = []
+    for prompt in (VALIDATE_PROMPT, NEXT_ACTION_PROMPT):
+        message_chain.add(USER, prompt.format(message=USER_CONTENT))
+        json_data = message_chain.build_payload(model=MODEL, temperature=TEMPERATURE)
+        payloads.append(json_data.decode())  # same bytes for the request and the api log
+
+    return payloads
+
+
+def legacy_full():
+    return legacy_payloads(legacy_chain(rows))
+
+
+def message_chain_full():
+    return message_chain_payloads(build_chain(rows))
+
+
+def legacy_live():
+    chain_rows = list(rows)
+    payloads = []
+    for _ in range(TURNS_PLAYED):
+        message_chain = legacy_chain(chain_rows)
+        if len(message_chain) > MAX_HISTORY_TURNS:
+            message_chain = [message_chain[0]] + message_chain[-MAX_HISTORY_TURNS:]
+        payloads.append(legacy_payloads(message_chain))
+        chain_rows.append((USER_CONTENT, ASSISTANT_CONTENT))
+
+    return payloads
+
+
+def message_chain_live():
+    chain_rows = list(rows)
+    payloads = []
+    for _ in range(TURNS_PLAYED):
+        message_chain = build_chain(chain_rows).truncated(MAX_HISTORY_TURNS)
+        payloads.append(message_chain_payloads(message_chain))
+        chain_rows.append((USER_CONTENT, ASSISTANT_CONTENT))
+
+    return payloads
+
+
+def cached_live():
+    # the stored chain is encoded once, each turn only appends the stored turn to the cache
+    chain_cache = ChainCache(max_chains=1)
+    chain_cache.put(CHAIN_ID, build_chain(rows), TURN_COUNT)
+    payloads = []
+    for valid_message_id in range(TURN_COUNT + 1, TURN_COUNT + 1 + TURNS_PLAYED):
+        message_chain, _ = chain_cache.get(CHAIN_ID)
+        payloads.append(message_chain_payloads(message_chain.truncated(MAX_HISTORY_TURNS)))
+        chain_cache.append(CHAIN_ID, valid_message_id, USER_CONTENT, ASSISTANT_CONTENT)
+
+    return payloads
+
+
+def main():
+    assert legacy_full() == message_chain_full(), "full payloads differ"
+    assert legacy_live() == message_chain_live() == cached_live(), "live payloads differ"
+
+    number = 100
+    cases = (
+        ("full", 1, (("legacy", legacy_full), ("message_chain", message_chain_full))),
+        ("live", TURNS_PLAYED, (
+            ("legacy", legacy_live),
+            ("message_chain", message_chain_live),
+            ("cached", cached_live)
+        )),
+    )
+    for case, turns, funcs in cases:
+        for name, func in funcs:
+            best = min(timeit.repeat(func, number=number, repeat=5))
+            print(f"{case} {name}: {best / number / turns * 1e6:.1f} us per turn ({TURN_COUNT} turn chain)")
+
+
+if __name__ == "__main__":
+    main()
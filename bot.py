@@ -3,10 +3,14 @@ import logging
 import discord
 import functools
 import asyncio
+import concurrent.futures
+import os
+import signal
 
 from src import config
 from src.db import AdventureDB, User, UserMessage
 from src import openai
+from src.lifecycle import TurnLifecycle
 
 
 logger = logging.getLogger('bot')
@@ -18,6 +22,8 @@ logger.addHandler(handler)
 
 intents = discord.Intents.default()
 client = discord.Client(intents=intents)
+lifecycle = TurnLifecycle(drain_seconds=config.settings['shutdown_drain_seconds'])
+turn_executor = concurrent.futures.ThreadPoolExecutor()
 
 
 def print_commands(user: User, message: UserMessage, db: AdventureDB) -> str:
@@ -32,8 +38,7 @@ def repeat_last_message(user: User, message: UserMessage, db: AdventureDB) -> st
         response_message = "You are currently not on an adventure. Use !start to begin one or !help for more options."
     else:
         message_chain = db.get_message_chain(current_adventure_chain=current_adventure_chain)
-        print(message_chain)
-        response_message = message_chain[-1]['content']
+        response_message = message_chain[-1].content
 
     return response_message
 
@@ -117,8 +122,7 @@ async def handle_adventure_message(user: User, message: UserMessage, db: Adventu
             # TODO fix this hack
             if len(message_chain) > 21:
                 print(f"len(message_chain)={len(message_chain)}")
-                # print(message_chain)
-                message_chain = [message_chain[0]] + message_chain[-21:]
+                message_chain = message_chain.truncated(21)
             message.rate_limit_count = 1  # openai api call rate limit
             db.commit()
             ai_response = openai.generate_invalid_message(
@@ -165,24 +169,30 @@ async def on_message(message):
             return
 
         if message.content:
-            db = AdventureDB()
-            user = db.get_discord_user(user=message.author)
-            if user is None:
-                user = db.add_discord_user(user=message.author)
-            logger.debug(f"user={user.name}#{user.id} message.content={message.content}")
-            clean_message = message.content[message.content.find('>')+2:]   # remove <@> from message
-            user_message = db.store_user_message(user_id=user.id, content=clean_message)  # store message
-
-            if clean_message.find("!") == 0:
-                response_message = handle_commands(user=user, message=user_message, db=db)
-            else:
-                response_message = await client.loop.run_in_executor(None, run_coroutine, handle_adventure_message(user, user_message, db))
-                # response_message = await handle_adventure_message(user=user, message=user_message, db=db)
-
-            db.commit()
-            db.close()
-
-            await message.channel.send(response_message)
+            if not lifecycle.accepting:
+                await message.channel.send("I'm restarting right now. Try again in a minute or so...")
+                return
+
+            with lifecycle.turn() as turn_message_ids:
+                db = AdventureDB()
+                user = db.get_discord_user(user=message.author)
+                if user is None:
+                    user = db.add_discord_user(user=message.author)
+                logger.debug(f"user={user.name}#{user.id} message.content={message.content}")
+                clean_message = message.content[message.content.find('>')+2:]   # remove <@> from message
+                user_message = db.store_user_message(user_id=user.id, content=clean_message)  # store message
+                turn_message_ids.add(user_message.id)
+
+                if clean_message.find("!") == 0:
+                    response_message = handle_commands(user=user, message=user_message, db=db)
+                else:
+                    response_message = await client.loop.run_in_executor(turn_executor, run_coroutine, handle_adventure_message(user, user_message, db))
+                    # response_message = await handle_adventure_message(user=user, message=user_message, db=db)
+
+                db.commit()
+                db.close()
+
+                await message.channel.send(response_message)
     except Exception as e:
         logger.exception(e)
         raise e
@@ -192,4 +202,61 @@ def run_coroutine(coro):
     return asyncio.run(coro)
 
 
-client.run(config.settings['discord_bot_token'])
\ No newline at end of file
+def recover_orphaned_messages(older_than: datetime.datetime):
+    # refund rate limit slots of turns that were in flight when a previous process stopped
+    db = AdventureDB()
+    refund_count = db.refund_orphaned_user_messages(older_than=older_than)
+    db.commit()
+    db.close()
+    logger.info(f"refunded orphaned user messages older_than={older_than} count={refund_count}")
+
+
+def refund_in_flight_messages():
+    # refund rate limit slots of turns abandoned when the drain timed out
+    db = AdventureDB()
+    refund_count = db.refund_user_messages(user_message_ids=lifecycle.in_flight_message_ids())
+    db.commit()
+    db.close()
+    logger.info(f"refunded in flight user messages count={refund_count}")
+
+
+async def shutdown():
+    logger.info("shutdown requested, no longer accepting turns")
+    drained = await lifecycle.drain()
+    logger.info(f"shutdown drained={drained} in_flight={lifecycle.in_flight}")
+    if not drained:
+        turn_executor.shutdown(wait=False, cancel_futures=True)
+        refund_in_flight_messages()
+    await client.close()
+
+
+def handle_signal():
+    if lifecycle.accepting:
+        asyncio.ensure_future(shutdown())
+    else:  # second signal while draining
+        logger.error(f"shutdown forced in_flight={lifecycle.in_flight}")
+        logging.shutdown()
+        os._exit(1)
+
+
+async def main():
+    discord.utils.setup_logging()
+    loop = asyncio.get_running_loop()
+    # by the drain deadline any turn from before startup was answered or refunded by its own process,
+    # what is left was orphaned by a crash
+    loop.call_later(
+        config.settings['shutdown_drain_seconds'],
+        recover_orphaned_messages,
+        datetime.datetime.utcnow()
+    )
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, handle_signal)
+    async with client:
+        await client.start(config.settings['discord_bot_token'])
+
+
+asyncio.run(main())
+if lifecycle.timed_out:
+    # don't wait for abandoned turn threads, their messages were refunded
+    logging.shutdown()
+    os._exit(1)
@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import time
+from typing import Iterator, List, Optional, Set, Tuple
+
+import requests
+import yaml
+
+from src import config
+from src.db import AdventureDB
+from src.message_chain import MessageChain, Turn, SYSTEM, USER, ASSISTANT
+
+logger = logging.getLogger('replay')
+logger.setLevel(logging.DEBUG)
+handler = logging.FileHandler(filename=config.settings['discord_log_path'], encoding='utf-8', mode='a')
+handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+logger.addHandler(handler)
+
+MAX_HISTORY_TURNS = 21  # same history window as bot.handle_adventure_message
+BATCH_URL = "/v1/chat/completions"
+BATCH_MAX_REQUESTS = 50000  # openai batch input file limits
+BATCH_MAX_BYTES = 200 * 1024 * 1024
+REQUEST_TIMEOUT_SECONDS = 120
+MAX_BACKOFF_SECONDS = 60
+QUOTA_ERROR_TYPES = ("insufficient_quota", "billing_hard_limit_reached")
+
+
+def load_prompts(prompts_path: str) -> dict:
+    with open(prompts_path, 'r') as stream:
+        return yaml.safe_load(stream)
+
+
+def iter_replay_turns(
+        db: AdventureDB,
+        prompts: dict,
+        batch_size: int,
+        replayed_ids: Set[int]) -> Iterator[Tuple[int, int, MessageChain, Turn]]:
+    """
+    yields (valid_message_id, chain_id, request_chain, failure_turn) for every stored valid turn not yet replayed.
+    request_chain is the same request bot.handle_adventure_message sends to generate_adventure_ai_response:
+    the stored adventure up to that turn, the validate prompt turn then the next action prompt turn.
+    failure_turn is appended when the response hits the 'AI language model' fallback
+    """
+    chain_id = None
+    message_chain = None
+    for r in db.stream_valid_messages(batch_size=batch_size):
+        if r.chain_id != chain_id:
+            chain_id = r.chain_id
+            message_chain = MessageChain()
+            message_chain.add(SYSTEM, r.system)
+            message_chain.add(USER, r.adventure_seed)
+            message_chain.add(ASSISTANT, r.adventure_seed_response)
+
+        if r.valid_message_id not in replayed_ids:
+            request_chain = message_chain.truncated(MAX_HISTORY_TURNS).copy()
+            request_chain.add(USER, prompts['validate_prompt'].format(message=r.user))
+            request_chain.add(USER, prompts['next_action_prompt'].format(message=r.user))
+            failure_turn = Turn(USER, prompts['failure_prompt'].format(message=r.user))
+            yield r.valid_message_id, r.chain_id, request_chain, failure_turn
+
+        message_chain.add(USER, r.user)
+        message_chain.add(ASSISTANT, r.assistant)
+
+
+def post_chat_completion(payload: bytes) -> Optional[str]:
+    attempt_count = 0
+
+    while attempt_count < config.settings['attempt_limit']:
+        try:
+            r = requests.post(
+                'https://api.openai.com/v1/chat/completions',
+                headers={
+                    'Authorization': 'Bearer {}'.format(config.settings['openapi_token']),
+                    'Content-Type': 'application/json'
+                },
+                data=payload,
+                timeout=REQUEST_TIMEOUT_SECONDS
+            )
+            response = json.loads(r.content)
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"OpenAI API request failed attempt_count={attempt_count} error={e!r}")
+            response = None
+        else:
+            if 'choices' in response:
+                return f"{response['choices'][0]['message']['content']}"
+            logger.error(f"Invalid OpenAI API status_code={r.status_code} response={r.content}")
+
+        try:
+            error_type = response['error'].get('type') or response['error'].get('code')
+        except (KeyError, TypeError, AttributeError):
+            error_type = None
+        if error_type in QUOTA_ERROR_TYPES:  # retrying won't help until the quota is raised
+            return None
+        if not (response is None or r.status_code == 429 or error_type == 'server_error'):
+            return None
+        attempt_count = attempt_count + 1
+        if attempt_count < config.settings['attempt_limit']:
+            time.sleep(min(2 ** attempt_count, MAX_BACKOFF_SECONDS))
+
+    return None
+
+
+def replay_content(model: str, temperature: float, request_chain: MessageChain, failure_turn: Turn) -> Optional[str]:
+    content = post_chat_completion(request_chain.build_payload(model=model, temperature=temperature))
+    if content is not None and 'AI language model' in content:  # same fallback as generate_adventure_ai_response
+        content = post_chat_completion(
+            request_chain.build_payload(model=model, temperature=temperature, next_turn=failure_turn)
+        )
+
+    return content
+
+
+async def replay_pool(run_name: str, model: str, prompts: dict, concurrency: int, batch_size: int) -> int:
+    read_db = AdventureDB()
+    write_db = AdventureDB()
+    replayed_ids = write_db.get_replayed_valid_message_ids(run_name=run_name)
+    print(f"resuming run_name={run_name} replayed={len(replayed_ids)}")
+
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    stored_count = 0
+
+    async def replay_turn(valid_message_id: int, chain_id: int, request_chain: MessageChain, failure_turn: Turn):
+        nonlocal stored_count
+        try:
+            content = await loop.run_in_executor(
+                executor, replay_content, model, prompts['validate_temperature'], request_chain, failure_turn
+            )
+            if content is None:
+                logger.error(f"replay failed run_name={run_name} valid_message_id={valid_message_id}")
+                return
+            write_db.store_replay_message(
+                run_name=run_name,
+                valid_message_id=valid_message_id,
+                chain_id=chain_id,
+                model=model,
+                content=content
+            )
+            write_db.commit()  # checkpoint
+            stored_count = stored_count + 1
+        except Exception as e:  # one failed turn is retried by the next run, don't abort this one
+            logger.exception(f"replay failed run_name={run_name} valid_message_id={valid_message_id} error={e!r}")
+            write_db.rollback()
+        finally:
+            semaphore.release()
+
+    try:
+        for valid_message_id, chain_id, request_chain, failure_turn in iter_replay_turns(
+                db=read_db, prompts=prompts, batch_size=batch_size, replayed_ids=replayed_ids):
+            await semaphore.acquire()  # bound the number of turns in flight
+            task = asyncio.ensure_future(replay_turn(valid_message_id, chain_id, request_chain, failure_turn))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        executor.shutdown(wait=True)
+        read_db.close()
+        write_db.close()
+
+    return stored_count
+
+
+def batch_file_path(batch_path: str, file_number: int) -> str:
+    root, ext = os.path.splitext(batch_path)
+
+    return f"{root}-{file_number:03d}{ext}"
+
+
+def export_batch(
+        run_name: str,
+        model: str,
+        prompts: dict,
+        batch_path: str,
+        batch_size: int,
+        max_requests: int) -> List[str]:
+    """
+    writes pending turns as numbered batch input files of at most max_requests requests and BATCH_MAX_BYTES each.
+    the 'AI language model' failure fallback is not applied to batch results
+    """
+    db = AdventureDB()
+    replayed_ids = db.get_replayed_valid_message_ids(run_name=run_name)
+    batch_paths = []
+    batch_file = None
+    request_count = 0
+    byte_count = 0
+
+    try:
+        for valid_message_id, chain_id, request_chain, failure_turn in iter_replay_turns(
+                db=db, prompts=prompts, batch_size=batch_size, replayed_ids=replayed_ids):
+            custom_id = json.dumps(f"{chain_id}-{valid_message_id}").encode()
+            line = b'{"custom_id": ' + custom_id + \
+                   b', "method": "POST", "url": ' + json.dumps(BATCH_URL).encode() + \
+                   b', "body": ' + request_chain.build_payload(
+                       model=model, temperature=prompts['validate_temperature']) + b'}\n'
+
+            if batch_file is None or request_count >= max_requests or byte_count + len(line) > BATCH_MAX_BYTES:
+                if batch_file is not None:
+                    batch_file.close()
+                batch_paths.append(batch_file_path(batch_path=batch_path, file_number=len(batch_paths)))
+                batch_file = open(batch_paths[-1], 'wb')
+                request_count = 0
+                byte_count = 0
+            batch_file.write(line)
+            request_count = request_count + 1
+            byte_count = byte_count + len(line)
+    finally:
+        if batch_file is not None:
+            batch_file.close()
+        db.close()
+
+    return batch_paths
+
+
+def import_batch(run_name: str, batch_output_paths: List[str]) -> int:
+    db = AdventureDB()
+    stored_count = 0
+
+    try:
+        replayed_ids = db.get_replayed_valid_message_ids(run_name=run_name)
+        for batch_output_path in batch_output_paths:
+            with open(batch_output_path, 'r', encoding='utf-8') as batch_output_file:
+                for line in batch_output_file:
+                    if not line.strip():
+                        continue
+                    try:
+                        result = json.loads(line)
+                        chain_id, valid_message_id = (int(i) for i in result['custom_id'].split("-"))
+                        if valid_message_id in replayed_ids:
+                            continue
+                        body = result['response']['body']
+                        content = f"{body['choices'][0]['message']['content']}"
+                        db.store_replay_message(
+                            run_name=run_name,
+                            valid_message_id=valid_message_id,
+                            chain_id=chain_id,
+                            model=body.get('model'),
+                            content=content
+                        )
+                        db.commit()  # checkpoint
+                    except Exception as e:  # one bad line is skipped, don't abort the import
+                        logger.exception(f"import failed run_name={run_name} path={batch_output_path} "
+                                         f"error={e!r} result={line}")
+                        db.rollback()
+                        continue
+                    replayed_ids.add(valid_message_id)
+                    stored_count = stored_count + 1
+    finally:
+        db.close()
+
+    return stored_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay stored adventures against new prompts or models")
+    parser.add_argument("--run-name", required=True, help="replay results and checkpoints are stored by run name")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows fetched per server side cursor batch")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="replay through a bounded pool of api requests")
+    run_parser.add_argument("--prompts", default="prompts.yaml")
+    run_parser.add_argument("--model", default=config.settings['openapi_model'])
+    run_parser.add_argument("--concurrency", type=int, default=4)
+
+    export_parser = subparsers.add_parser("export-batch", help="write pending turns as OpenAI batch jsonl files")
+    export_parser.add_argument("--prompts", default="prompts.yaml")
+    export_parser.add_argument("--model", default=config.settings['openapi_model'])
+    export_parser.add_argument("--max-requests", type=int, default=BATCH_MAX_REQUESTS,
+                               help="requests per batch file, files are numbered batch_path-000.jsonl, ...")
+    export_parser.add_argument("batch_path")
+
+    import_parser = subparsers.add_parser("import-batch", help="store the results of OpenAI batch output files")
+    import_parser.add_argument("batch_output_paths", nargs="+")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        stored_count = asyncio.run(replay_pool(
+            run_name=args.run_name,
+            model=args.model,
+            prompts=load_prompts(args.prompts),
+            concurrency=args.concurrency,
+            batch_size=args.batch_size
+        ))
+        print(f"replayed run_name={args.run_name} stored={stored_count}")
+    elif args.command == "export-batch":
+        batch_paths = export_batch(
+            run_name=args.run_name,
+            model=args.model,
+            prompts=load_prompts(args.prompts),
+            batch_path=args.batch_path,
+            batch_size=args.batch_size,
+            max_requests=args.max_requests
+        )
+        print(f"exported run_name={args.run_name} batch_paths={batch_paths}")
+    elif args.command == "import-batch":
+        stored_count = import_batch(run_name=args.run_name, batch_output_paths=args.batch_output_paths)
+        print(f"imported run_name={args.run_name} stored={stored_count}")
+
+
+if __name__ == "__main__":
+    main()
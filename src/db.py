@@ -1,15 +1,16 @@
 import sqlalchemy as sqla
-from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, Numeric, and_
+from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, Numeric, UniqueConstraint, and_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 
 import discord
 
 import logging
-from typing import Tuple
+from typing import Iterator, Set, Tuple
 import datetime
 
 from src import config
+from src.message_chain import ChainCache, MessageChain, SYSTEM, USER, ASSISTANT
 
 logger = logging.getLogger('db')
 logger.setLevel(logging.DEBUG)
@@ -86,23 +87,42 @@ class OpenAIAPILog(Base):
     output_json = Column(String)
 
 
+class AdventureReplayMessage(Base):
+    __tablename__ = "adventure_replay_messages"
+    __table_args__ = (UniqueConstraint('run_name', 'valid_message_id'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_name = Column(String, nullable=False)
+    valid_message_id = Column(Integer, ForeignKey('adventure_valid_message.id'), nullable=False)
+    chain_id = Column(Integer, ForeignKey('adventure_chains.id'), nullable=False)
+    model = Column(String)
+    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    content = Column(String)
+
+
 engine = sqla.create_engine(f"{config.settings['db_path']}")
 SessionMaker = sessionmaker(bind=engine)
 Base.metadata.create_all(engine)
+chain_cache = ChainCache(max_chains=config.settings['chain_cache_max_chains'])
 
 
 class AdventureDB:
     def __init__(self):
         self.session = SessionMaker()
+        self.pending_chain_turns = []  # valid turns added to chain_cache once committed
 
     def commit(self):
         self.session.commit()
+        for chain_turn in self.pending_chain_turns:
+            chain_cache.append(**chain_turn)
+        self.pending_chain_turns = []
 
     def rollback(self):
         self.session.rollback()
+        self.pending_chain_turns = []
 
     def close(self):
         self.session.rollback()
+        self.pending_chain_turns = []
 
     def get_discord_user(self, user: discord.User) -> User:
         discord_user = self.session.query(User).filter(User.discord_id == user.id).first()
@@ -147,6 +167,12 @@ class AdventureDB:
         )
         self.session.add(valid_message)
         self.session.flush()
+        self.pending_chain_turns.append({
+            "chain_id": adventure_chain.id,
+            "valid_message_id": valid_message.id,
+            "user": user_msg.content,
+            "assistant": ai_msg.content
+        })
 
         return valid_message
 
@@ -224,8 +250,20 @@ class AdventureDB:
     def end_adventure_chain(self, current_adventure_chain: AdventureMessageChain):
         current_adventure_chain.finished_at = datetime.datetime.now()
         self.session.flush()
+        chain_cache.discard(current_adventure_chain.id)
+
+    def get_message_chain(self, current_adventure_chain: AdventureMessageChain) -> MessageChain:
+        # only turns stored after the cached chain are queried and encoded
+        cached_chain = chain_cache.get(current_adventure_chain.id)
+        if cached_chain is None:
+            messages = MessageChain()
+            messages.add(SYSTEM, current_adventure_chain.system)
+            messages.add(USER, current_adventure_chain.adventure_seed)
+            messages.add(ASSISTANT, current_adventure_chain.adventure_seed_response)
+            last_valid_message_id = 0
+        else:
+            messages, last_valid_message_id = cached_chain
 
-    def get_message_chain(self, current_adventure_chain: AdventureMessageChain):
         message_chain = self.session.query(
             AdventureValidMessage,
             UserMessage,
@@ -237,35 +275,111 @@ class AdventureDB:
             AIMessage,
             (AdventureValidMessage.ai_message_id == AIMessage.id)
         ).filter(
-            AdventureValidMessage.chain_id == current_adventure_chain.id
+            AdventureValidMessage.chain_id == current_adventure_chain.id,
+            AdventureValidMessage.id > last_valid_message_id
         ).with_entities(
+            AdventureValidMessage.id.label('valid_message_id'),
             UserMessage.content.label('user'),
             AIMessage.content.label('assistant'),
         ).order_by(
             UserMessage.timestamp.asc()
         )
 
-        messages = [{
-            "role": "system",
-            "content": f"{current_adventure_chain.system}"
-        }, {
-            "role": "user",
-            "content": f"{current_adventure_chain.adventure_seed}"
-        }, {
-            "role": "assistant",
-            "content": f"{current_adventure_chain.adventure_seed_response}"
-        }]
         for r in message_chain.all():
-            messages.extend([{
-                "role": "user",
-                "content": f"{r.user}"
-            }, {
-                "role": "assistant",
-                "content": f"{r.assistant}"
-            }])
+            messages.add(USER, r.user)
+            messages.add(ASSISTANT, r.assistant)
+            last_valid_message_id = max(last_valid_message_id, r.valid_message_id)
+        chain_cache.put(current_adventure_chain.id, messages, last_valid_message_id)
 
         return messages
 
+    def _refund_user_messages(self, *filters) -> int:
+        # adventure messages that were rate limited but never got a valid or invalid ai response stored
+        orphaned_messages = self.session.query(
+            UserMessage
+        ).filter(
+            UserMessage.rate_limit_count > 0,
+            UserMessage.timestamp >= (datetime.datetime.utcnow() - datetime.timedelta(hours=1)),
+            ~UserMessage.content.startswith("!"),
+            ~UserMessage.adventure_valid_messages.any(),
+            ~UserMessage.adventure_invalid_messages.any(),
+            *filters
+        ).all()
+
+        for orphaned_message in orphaned_messages:
+            logger.info(f"refunding orphaned user_message id={orphaned_message.id} user_id={orphaned_message.user_id}")
+            orphaned_message.rate_limit_count = 0
+        self.session.flush()
+
+        return len(orphaned_messages)
+
+    def refund_orphaned_user_messages(self, older_than: datetime.datetime) -> int:
+        return self._refund_user_messages(UserMessage.timestamp < older_than)
+
+    def refund_user_messages(self, user_message_ids: Set[int]) -> int:
+        if not user_message_ids:
+            return 0
+
+        return self._refund_user_messages(UserMessage.id.in_(user_message_ids))
+
+    def stream_valid_messages(self, batch_size: int) -> Iterator:
+        # server side cursor over every valid turn ordered by chain then turn
+        valid_messages = self.session.query(
+            AdventureValidMessage
+        ).join(
+            AdventureMessageChain,
+            (AdventureValidMessage.chain_id == AdventureMessageChain.id)
+        ).join(
+            UserMessage,
+            (AdventureValidMessage.user_message_id == UserMessage.id)
+        ).join(
+            AIMessage,
+            (AdventureValidMessage.ai_message_id == AIMessage.id)
+        ).with_entities(
+            AdventureValidMessage.id.label('valid_message_id'),
+            AdventureMessageChain.id.label('chain_id'),
+            AdventureMessageChain.system.label('system'),
+            AdventureMessageChain.adventure_seed.label('adventure_seed'),
+            AdventureMessageChain.adventure_seed_response.label('adventure_seed_response'),
+            UserMessage.content.label('user'),
+            AIMessage.content.label('assistant'),
+        ).order_by(
+            AdventureMessageChain.id.asc(),
+            UserMessage.timestamp.asc()
+        ).yield_per(batch_size)
+
+        return iter(valid_messages)
+
+    def get_replayed_valid_message_ids(self, run_name: str) -> Set[int]:
+        replayed_ids = self.session.query(
+            AdventureReplayMessage.valid_message_id
+        ).filter(
+            AdventureReplayMessage.run_name == run_name
+        ).all()
+
+        return {r.valid_message_id for r in replayed_ids}
+
+    def store_replay_message(
+            self,
+            run_name: str,
+            valid_message_id: int,
+            chain_id: int,
+            model: str,
+            content: str
+    ) -> AdventureReplayMessage:
+        replay_message = AdventureReplayMessage(
+            run_name=run_name,
+            valid_message_id=valid_message_id,
+            chain_id=chain_id,
+            model=model,
+            content=content,
+            timestamp=datetime.datetime.utcnow()
+        )
+        self.session.add(replay_message)
+        self.session.flush()
+
+        return replay_message
+
     def store_openai_log(
             self,
             input_str: str,
@@ -0,0 +1,64 @@
+import asyncio
+import contextlib
+import logging
+from typing import Set
+
+from src import config
+
+logger = logging.getLogger('lifecycle')
+logger.setLevel(logging.DEBUG)
+handler = logging.FileHandler(filename=config.settings['discord_log_path'], encoding='utf-8', mode='a')
+handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+logger.addHandler(handler)
+
+
+class TurnLifecycle:
+    """
+    tracks in flight turns so shutdown can stop accepting new turns and wait for
+    the running ones to finish up to drain_seconds.
+    each turn records the user message ids it charged so they can be refunded if
+    the drain times out
+    """
+    def __init__(self, drain_seconds: float):
+        self.drain_seconds = drain_seconds
+        self.accepting = True
+        self.timed_out = False
+        self._turn_message_ids = {}  # in flight turn id to the user message ids it charged
+        self._idle = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._turn_message_ids)
+
+    def in_flight_message_ids(self) -> Set[int]:
+        return set().union(*self._turn_message_ids.values())
+
+    @contextlib.contextmanager
+    def turn(self):
+        message_ids = set()
+        self._turn_message_ids[id(message_ids)] = message_ids
+        try:
+            yield message_ids
+        finally:
+            del self._turn_message_ids[id(message_ids)]
+            if self.in_flight == 0 and self._idle is not None:
+                self._idle.set()
+
+    def stop_accepting(self):
+        self.accepting = False
+
+    async def drain(self) -> bool:
+        self.stop_accepting()
+        if self.in_flight == 0:
+            return True
+
+        self._idle = asyncio.Event()
+        logger.info(f"draining in_flight={self.in_flight} drain_seconds={self.drain_seconds}")
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=self.drain_seconds)
+        except asyncio.TimeoutError:
+            logger.error(f"drain timed out in_flight={self.in_flight}")
+            self.timed_out = True
+            return False
+
+        return True
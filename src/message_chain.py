@@ -0,0 +1,149 @@
+import collections
+import json
+import threading
+from typing import Iterable, Optional, Tuple
+
+SYSTEM = "system"
+USER = "user"
+ASSISTANT = "assistant"
+
+# encoded message prefixes, matches json.dumps default separators
+ROLE_PREFIXES = {
+    role: f'{{"role": {json.dumps(role)}, "content": '.encode()
+    for role in (SYSTEM, USER, ASSISTANT)
+}
+
+
+class Turn:
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = str(content)  # same coercion as the previous f-string messages
+
+    def encode(self) -> bytes:
+        return ROLE_PREFIXES[self.role] + json.dumps(self.content).encode() + b"}"
+
+
+class MessageChain:
+    """
+    list of Turns for an adventure, each turn is json encoded once when added
+    and the encoded history is reused for every payload built from the chain
+    """
+    __slots__ = ("turns", "_encoded_turns", "_encoded_history")
+
+    def __init__(self, turns: Iterable[Turn] = ()):
+        self.turns = []
+        self._encoded_turns = []
+        self._encoded_history = None
+        for turn in turns:
+            self.append(turn)
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def __getitem__(self, index: int) -> Turn:
+        return self.turns[index]
+
+    def __iter__(self):
+        return iter(self.turns)
+
+    def append(self, turn: Turn):
+        encoded_turn = turn.encode()
+        self.turns.append(turn)
+        self._encoded_turns.append(encoded_turn)
+        if self._encoded_history is not None:
+            if self._encoded_history:
+                self._encoded_history = self._encoded_history + b", " + encoded_turn
+            else:
+                self._encoded_history = encoded_turn
+
+    def add(self, role: str, content: str):
+        self.append(Turn(role=role, content=content))
+
+    def truncated(self, max_turns: int) -> "MessageChain":
+        # keep the system turn and the most recent max_turns turns
+        if len(self.turns) <= max_turns + 1:
+            return self
+        chain = MessageChain()
+        indexes = [0] + list(range(len(self.turns) - max_turns, len(self.turns)))
+        for i in indexes:
+            chain.turns.append(self.turns[i])
+            chain._encoded_turns.append(self._encoded_turns[i])
+
+        return chain
+
+    def copy(self) -> "MessageChain":
+        chain = MessageChain()
+        chain.turns = list(self.turns)
+        chain._encoded_turns = list(self._encoded_turns)
+        chain._encoded_history = self._encoded_history
+
+        return chain
+
+    def encoded_history(self) -> bytes:
+        if self._encoded_history is None:
+            self._encoded_history = b", ".join(self._encoded_turns)
+
+        return self._encoded_history
+
+    def build_payload(self, model: str, temperature: float, next_turn: Optional[Turn] = None) -> bytes:
+        """
+        encode a chat completion request body from the cached history bytes,
+        the same bytes are sent to the api and stored in the api log.
+        next_turn is encoded after the history without being added to the chain
+        """
+        messages = self.encoded_history()
+        if next_turn is not None:
+            messages = messages + b", " + next_turn.encode() if messages else next_turn.encode()
+
+        return b'{"model": ' + json.dumps(model).encode() + \
+               b', "messages": [' + messages + \
+               b'], "temperature": ' + json.dumps(temperature).encode() + b'}'
+
+
+class ChainCache:
+    """
+    MessageChains by adventure chain id with the id of the last valid message they hold,
+    shared by every AdventureDB session in the process so stored turns are queried and
+    encoded once per chain. callers get copies, the cached chains are never handed out
+    """
+    def __init__(self, max_chains: int):
+        self.max_chains = max_chains
+        self._chains = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chain_id: int) -> Optional[Tuple[MessageChain, int]]:
+        with self._lock:
+            if chain_id not in self._chains:
+                return None
+            self._chains.move_to_end(chain_id)
+            message_chain, last_valid_message_id = self._chains[chain_id]
+
+            return message_chain.copy(), last_valid_message_id
+
+    def put(self, chain_id: int, message_chain: MessageChain, last_valid_message_id: int):
+        with self._lock:
+            if chain_id in self._chains and self._chains[chain_id][1] >= last_valid_message_id:
+                return
+            self._chains[chain_id] = (message_chain.copy(), last_valid_message_id)
+            self._chains.move_to_end(chain_id)
+            while len(self._chains) > self.max_chains:
+                self._chains.popitem(last=False)
+
+    def append(self, chain_id: int, valid_message_id: int, user: str, assistant: str):
+        with self._lock:
+            if chain_id not in self._chains:
+                return
+            message_chain, last_valid_message_id = self._chains[chain_id]
+            if valid_message_id <= last_valid_message_id:
+                # committed out of order, drop the chain so the next get queries it in order
+                del self._chains[chain_id]
+                return
+            message_chain.add(USER, user)
+            message_chain.add(ASSISTANT, assistant)
+            self._chains[chain_id] = (message_chain, valid_message_id)
+
+    def discard(self, chain_id: int):
+        with self._lock:
+            self._chains.pop(chain_id, None)
@@ -7,6 +7,7 @@ import yaml
 
 from src import config
 from src.db import AdventureDB
+from src.message_chain import MessageChain, SYSTEM, USER
 
 logger = logging.getLogger('openai')
 logger.setLevel(logging.DEBUG)
@@ -27,19 +28,14 @@ def start_adventure_chain(db: AdventureDB):
     adventure_seed = random.choice(prompts['adventure_seeds'])
     adventure_seed_response = "adventure_seed_response"
 
-    message_chain = [{
-        "role": "system",
-        "content": f"{adventure_system}"
-    }, {
-        "role": "user",
-        "content": f"{adventure_seed['seed']}"
-    }]
+    message_chain = MessageChain()
+    message_chain.add(SYSTEM, adventure_system)
+    message_chain.add(USER, adventure_seed['seed'])
 
-    json_data = {
-        "model": config.settings['openapi_model'],
-        "messages": message_chain,
-        "temperature": prompts['adventure_temperature']
-    }
+    json_data = message_chain.build_payload(
+        model=config.settings['openapi_model'],
+        temperature=prompts['adventure_temperature']
+    )
 
     attempt_count = 0
     adventure_seed_response = None
@@ -48,11 +44,14 @@ def start_adventure_chain(db: AdventureDB):
         print(f"start attempt_count={attempt_count}")
         r = requests.post(
             'https://api.openai.com/v1/chat/completions',
-            headers={'Authorization': 'Bearer {}'.format(config.settings['openapi_token'])},
-            json=json_data
+            headers={
+                'Authorization': 'Bearer {}'.format(config.settings['openapi_token']),
+                'Content-Type': 'application/json'
+            },
+            data=json_data
         )
         openai_log = db.store_openai_log(
-            input_str=json.dumps(json_data),
+            input_str=json_data.decode(),
             output_str=f"{r.content}"
         )
         db.commit()
@@ -74,17 +73,13 @@ def start_adventure_chain(db: AdventureDB):
     return adventure_system, f"{adventure_seed['seed']}", adventure_seed_response
 
 
-def generate_invalid_message(message: str, message_chain: list, db: AdventureDB):
-    message_chain.append({
-        "role": "user",
-        "content": prompts['validate_prompt'].format(message=message)
-    })
+def generate_invalid_message(message: str, message_chain: MessageChain, db: AdventureDB):
+    message_chain.add(USER, prompts['validate_prompt'].format(message=message))
 
-    json_data = {
-        "model": config.settings['openapi_model'],
-        "messages": message_chain,
-        "temperature": prompts['validate_temperature']
-    }
+    json_data = message_chain.build_payload(
+        model=config.settings['openapi_model'],
+        temperature=prompts['validate_temperature']
+    )
 
     attempt_count = 0
     response = "Oops, I'm a bit busy right now. I should be ready in a minute or so..."
@@ -93,11 +88,14 @@ def generate_invalid_message(message: str, message_chain: list, db: AdventureDB)
         print(f"invalid verify attempt_count={attempt_count}")
         r = requests.post(
             'https://api.openai.com/v1/chat/completions',
-            headers={'Authorization': 'Bearer {}'.format(config.settings['openapi_token'])},
-            json=json_data
+            headers={
+                'Authorization': 'Bearer {}'.format(config.settings['openapi_token']),
+                'Content-Type': 'application/json'
+            },
+            data=json_data
         )
         openai_log = db.store_openai_log(
-            input_str=json.dumps(json_data),
+            input_str=json_data.decode(),
             output_str=f"{r.content}"
         )
         db.commit()
@@ -138,19 +136,15 @@ def generate_invalid_message(message: str, message_chain: list, db: AdventureDB)
 #     }
 
 
-def generate_adventure_api_failure_response(message: str, message_chain: list, db: AdventureDB):
+def generate_adventure_api_failure_response(message: str, message_chain: MessageChain, db: AdventureDB):
     content_str = prompts['failure_prompt'].format(message=message)
 
-    message_chain.append({
-        "role": "user",
-        "content": content_str
-    })
+    message_chain.add(USER, content_str)
 
-    json_data = {
-        "model": config.settings['openapi_model'],
-        "messages": message_chain,
-        "temperature": prompts['validate_temperature']
-    }
+    json_data = message_chain.build_payload(
+        model=config.settings['openapi_model'],
+        temperature=prompts['validate_temperature']
+    )
 
     attempt_count = 0
     response = "Oops, I'm a bit busy right now. I should be ready in a minute or so..."
@@ -159,11 +153,14 @@ def generate_adventure_api_failure_response(message: str, message_chain: list, d
         print(f"response attempt_count={attempt_count}")
         r = requests.post(
             'https://api.openai.com/v1/chat/completions',
-            headers={'Authorization': 'Bearer {}'.format(config.settings['openapi_token'])},
-            json=json_data
+            headers={
+                'Authorization': 'Bearer {}'.format(config.settings['openapi_token']),
+                'Content-Type': 'application/json'
+            },
+            data=json_data
         )
         openai_log = db.store_openai_log(
-            input_str=json.dumps(json_data),
+            input_str=json_data.decode(),
             output_str=f"{r.content}"
         )
         db.close()
@@ -184,17 +181,13 @@ def generate_adventure_api_failure_response(message: str, message_chain: list, d
     return response
 
 
-def generate_adventure_ai_response(message: str, message_chain: list, db: AdventureDB):
-    message_chain.append({
-        "role": "user",
-        "content": prompts['next_action_prompt'].format(message=message)
-    })
+def generate_adventure_ai_response(message: str, message_chain: MessageChain, db: AdventureDB):
+    message_chain.add(USER, prompts['next_action_prompt'].format(message=message))
 
-    json_data = {
-        "model": config.settings['openapi_model'],
-        "messages": message_chain,
-        "temperature": prompts['validate_temperature']
-    }
+    json_data = message_chain.build_payload(
+        model=config.settings['openapi_model'],
+        temperature=prompts['validate_temperature']
+    )
 
     attempt_count = 0
     response = "Oops, I'm a bit busy right now. I should be ready in a minute or so..."
@@ -203,11 +196,14 @@ def generate_adventure_ai_response(message: str, message_chain: list, db: Advent
         print(f"response attempt_count={attempt_count}")
         r = requests.post(
             'https://api.openai.com/v1/chat/completions',
-            headers={'Authorization': 'Bearer {}'.format(config.settings['openapi_token'])},
-            json=json_data
+            headers={
+                'Authorization': 'Bearer {}'.format(config.settings['openapi_token']),
+                'Content-Type': 'application/json'
+            },
+            data=json_data
         )
         openai_log = db.store_openai_log(
-            input_str=json.dumps(json_data),
+            input_str=json_data.decode(),
             output_str=f"{r.content}"
         )
         db.close()